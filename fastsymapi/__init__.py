@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastsymapi.sql_db import models
 from fastsymapi.logging import logger
 from fastsymapi.sql_db.database import engine
@@ -12,7 +13,7 @@ def create_app():
     models.base.metadata.create_all(bind=engine)
 
     # instantiate FastAPI
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
 
     # Symbol API
     app.include_router(sym)
@@ -26,5 +27,5 @@ app = create_app()
 
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "ok"}
@@ -1,15 +1,29 @@
+from sqlalchemy import select, update, bindparam
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert
 from fastsymapi.sql_db import models
 
+# Built once so every lookup hits SQLAlchemy's compiled statement cache
+_find_pdb_entry_stmt = select(models.SymbolEntry).where(models.SymbolEntry.guid == bindparam("guid"),
+                                                        models.SymbolEntry.pdbfile == bindparam("pdbfile"))
+
 def find_pdb_entry(db: Session, guid: str, pdbfile: str):
     """ Find a PDB entry """
-    return db.query(models.SymbolEntry).filter(models.SymbolEntry.guid == guid, 
-                                               models.SymbolEntry.pdbfile == pdbfile).first()
+    return db.execute(_find_pdb_entry_stmt, {"guid": guid, "pdbfile": pdbfile}).scalar_one_or_none()
+
+def find_pdb_entries(db: Session, skip: int = 0, limit: int = None):
+    """ Return the PDB entries as plain row mappings, skipping ORM instances """
+    return db.execute(select(models.SymbolEntry.__table__).offset(skip).limit(limit)).mappings().all()
 
 def find_still_downloading(db: Session):
     """ Return all still downloading PDB entries """
     return db.query(models.SymbolEntry).filter(models.SymbolEntry.downloading == True).all()
 
+def reset_still_downloading(db: Session) -> None:
+    """ Flag all still downloading PDB entries as no longer downloading """
+    db.execute(update(models.SymbolEntry).where(models.SymbolEntry.downloading == True).values(downloading=False))
+    db.commit()
+
 def create_pdb_entry(db: Session, guid: str, pdbname: str, pdbfile: str, found: bool = False):
     """ Create a new PDB entry """
     pdb_entry = models.SymbolEntry(pdbname=pdbname, guid=guid, pdbfile=pdbfile, found=found)
@@ -18,8 +32,20 @@ def create_pdb_entry(db: Session, guid: str, pdbname: str, pdbfile: str, found:
     db.refresh(pdb_entry)
     return pdb_entry
 
+def claim_pdb_entry_download(db: Session, guid: str, pdbname: str, pdbfile: str):
+    """ Create or flag a PDB entry as downloading, returns None if it already is """
+    stmt = insert(models.SymbolEntry).values(
+        guid=guid, pdbname=pdbname, pdbfile=pdbfile, downloading=True, found=False
+    ).on_conflict_do_update(
+        index_elements=["guid", "pdbfile"],
+        set_={"downloading": True},
+        where=models.SymbolEntry.downloading == False
+    ).returning(models.SymbolEntry)
+    pdb_entry = db.scalars(stmt).first()
+    db.commit()
+    return pdb_entry
+
 def modify_pdb_entry(db: Session, pdbentry: models.SymbolEntry) -> None:
-    """ Modify a PDB entry """
+    """ Modify a PDB entry, callers do not read it back so it is not refreshed """
     db.add(pdbentry)
-    db.commit()
-    db.refresh(pdbentry)
\ No newline at end of file
+    db.commit()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -7,9 +7,21 @@ SQLALCHEMY_DATABASE_URL = "sqlite:///./fsymapi.db"
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread":False}, 
     pool_size=20,
-    max_overflow=30
+    max_overflow=30,
+    query_cache_size=1200
 )
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """ Use WAL so commits do not fsync the whole database and readers do not block writers """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 base = declarative_base()
@@ -1,22 +1,77 @@
-from fastapi import APIRouter, Depends, Response, BackgroundTasks, Request
-from fastapi.responses import FileResponse, StreamingResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Depends, Response, Request
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse
 from fastsymapi.sql_db.database import get_db, session_local
 from fastsymapi.sql_db import crud, models
 from fastsymapi.logging import logger
+from fastsymapi.validation import validate_pdb_entry_fields
 import requests
-import click
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError, IncompleteRead
 from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cachetools import LRUCache, TTLCache
+import threading
+import asyncio
 import os
-import shutil
-import gzip
+
+# ISA-L's igzip is a drop-in replacement for gzip with much faster
+# compression and decompression, fall back to the standard library
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 sym = APIRouter()
 
-CHUNK_SIZE = 1024*1024*2
+# Smaller chunks keep per-download memory low without costing throughput
+CHUNK_SIZE = 1024*128
+
+# Chunk size used to stream a download, by the minimum size of the download.
+# Large PDBs use bigger chunks to cut per-chunk overhead in the download loop
+DOWNLOAD_CHUNK_SIZES = (
+    (1024*1024*64, 1024*256),
+    (0, CHUNK_SIZE)
+)
+
+# Chunk size used when decompressing cached symbols, matches gzip.READ_BUFFER_SIZE
+GZIP_READ_SIZE = 1024*128
+
+# Decompressed chunks read ahead of the client when serving non-gzip clients
+DECOMPRESS_PREFETCH_CHUNKS = 8
+
+# Buffer size of the temporary file the downloaded symbol is written to
+FILE_WRITE_BUFFER_SIZE = 1024*256
+
+# PDBs compress well even at the fastest level, CPU is the bottleneck
+GZIP_COMPRESS_LEVEL = 1
 
 SYMBOL_PATH = os.path.join(os.path.dirname(__file__), "symbols")
 
+# Seconds a request waits for an in-flight download of the same symbol
+IN_FLIGHT_WAIT_TIMEOUT = 10
+
+# Downloads running in this process, keyed on (guid, pdbfile)
+_in_flight: dict[tuple[str, str], asyncio.Event] = {}
+
+# Symbols that no server had, keyed on (guid, pdbfile), are not looked up again
+# until they expire from this cache
+NOT_FOUND_CACHE_TTL = 3600
+_not_found = TTLCache(maxsize=100_000, ttl=NOT_FOUND_CACHE_TTL)
+_not_found_lock = threading.Lock()
+
+# Symbols, keyed on (guid, pdbfile), that were just found missing from the cache.
+# Clients polling for a symbol while it downloads are answered without a stat
+# or a database claim, entries are dropped early when a download finishes
+MISSING_FILE_CACHE_TTL = 1
+_missing_files = TTLCache(maxsize=10_000, ttl=MISSING_FILE_CACHE_TTL)
+
+# Cached symbols, keyed on (guid, pdbfile), known to have a database entry
+_known_entries = LRUCache(maxsize=100_000)
+
+# nginx internal location that serves SYMBOL_PATH when X-Accel-Redirect is used
+X_ACCEL_REDIRECT_PATH = "/internal/symbols"
+
 SYM_URLS = [
     "http://msdl.microsoft.com/download/symbols",
     "http://chromium-browser-symsrv.commondatastorage.googleapis.com",
@@ -24,32 +79,187 @@ SYM_URLS = [
     "http://symbols.mozilla.org/try"
 ]
 
+# (connect, read) timeouts for requests made to the symbol servers
+REQUEST_TIMEOUT = (10, 60)
 
-def download_symbol(pdbentry: models.SymbolEntry, db: Session) -> None:
-    """ Iterate over SYM_URLs looking for the requested PDB file """
+# HEAD probes carry no body, a server that is slow to answer one loses the race
+PROBE_TIMEOUT = 5
+
+# Symbol server responses that definitely mean it does not have the symbol
+NOT_FOUND_STATUS_CODES = (404, 410)
+
+# Transient symbol server responses that are retried with a backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def create_requests_session() -> requests.Session:
+    """ Create a session that keeps connections alive and retries transient errors """
+
+    retry_strategy = Retry(
+        total=3,
+        connect=2,
+        read=2,
+        backoff_factor=0.2,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["HEAD", "GET"]),
+        raise_on_status=False,
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                          max_retries=retry_strategy)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by all downloads so connections to the symbol servers are kept alive
+_session = create_requests_session()
+
+# Downloads run on their own threads rather than Starlette's shared threadpool,
+# so long downloads can not starve the sync routes and dependencies
+MAX_CONCURRENT_DOWNLOADS = 16
+_download_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS,
+                                        thread_name_prefix="symbol-download")
+
+# Shared by all downloads to probe the symbol servers concurrently, sized so
+# every download can probe every server at once, probes that lost the race
+# keep running and must not hold up the probes of later downloads
+_probe_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS*len(SYM_URLS),
+                                     thread_name_prefix="symbol-probe")
+
+# Decompresses cached symbols ahead of the non-gzip clients they are sent to,
+# bounded so the number of threads does not grow with the number of clients
+MAX_CONCURRENT_DECOMPRESSIONS = 32
+_decompress_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DECOMPRESSIONS,
+                                          thread_name_prefix="symbol-decompress")
+
+
+def advise_sequential(file_handle) -> None:
+    """ Hint the kernel to read ahead aggressively, where posix_fadvise exists """
+
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file_handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def probe_symbol_url(session: requests.Session, symbol_url: str) -> bool | None:
+    """ Check with a HEAD request whether the symbol server has the PDB file,
+    None if the server could not tell, e.g. it was unreachable or failing """
+
+    try:
+        resp = session.head(symbol_url, allow_redirects=True,
+                            timeout=PROBE_TIMEOUT)
+    except requests.RequestException as exc:
+        logger.error(f"Could not reach symbol server: {symbol_url} {exc}")
+        return None
+
+    if resp.status_code in NOT_FOUND_STATUS_CODES:
+        logger.debug(f"Could not find symbol: {
+                     symbol_url} {resp.status_code}")
+        return False
+
+    if resp.status_code != 200:
+        logger.error(f"Symbol server failed: {
+                     symbol_url} {resp.status_code}")
+        return None
+
+    return True
 
-    # Iterate over the symbol server URLs
-    for sym_url in SYM_URLS:
 
-        # Check if symbol exists on the server
-        symbol_url = sym_url + \
-            f"/{pdbentry.pdbname}/{pdbentry.guid}/{pdbentry.pdbfile}"
-        resp = requests.get(symbol_url, stream=True)
+def find_symbol_url(session: requests.Session, pdbentry: models.SymbolEntry) -> tuple[str | None, bool]:
+    """ Probe all SYM_URLs concurrently and return the first that has the PDB file,
+    and whether every server answered that it does not have it """
 
-        # If the symbol was found download it
-        if resp.status_code == 200:
-            pdbentry.found = True
-            download_and_save_symbol(pdbentry, resp, db)
-            break
+    symbol_urls = [sym_url + f"/{pdbentry.pdbname}/{pdbentry.guid}/{pdbentry.pdbfile}"
+                   for sym_url in SYM_URLS]
 
-        # Unable to find PDB at any of the Symbol Servers
+    futures = {_probe_executor.submit(probe_symbol_url, session, symbol_url): symbol_url
+               for symbol_url in symbol_urls}
+    try:
+        is_missing = True
+        for future in as_completed(futures):
+            is_found = future.result()
+            if is_found:
+                return futures[future], False
+            if is_found is None:
+                is_missing = False
+        return None, is_missing
+
+    # Do not wait on the probes of the servers that lost the race
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def download_symbol(pdbentry: models.SymbolEntry, db: Session) -> None:
+    """ Look for the requested PDB file on the SYM_URLs and download it """
+
+    try:
+        # Check which symbol server has the symbol
+        symbol_url, is_missing = find_symbol_url(_session, pdbentry)
+        if symbol_url is None:
+            logger.debug(f"Could not find symbol on any server: {
+                         pdbentry.guid} {pdbentry.pdbfile}")
+
+            # Only remember symbols every server said it does not have, an
+            # unreachable or failing server may have it on the next request
+            if is_missing:
+                with _not_found_lock:
+                    _not_found[(pdbentry.guid, pdbentry.pdbfile)] = True
+
+        # Download the symbol from the first server that has it
         else:
-            logger.debug(f"Could not find symbol: {
-                         symbol_url} {resp.status_code}")
+            try:
+                with _session.get(symbol_url, stream=True,
+                                  timeout=REQUEST_TIMEOUT) as resp:
+                    if resp.status_code == 200:
+                        pdbentry.found = True
+                        download_and_save_symbol(pdbentry, resp, db)
+                    else:
+                        logger.debug(f"Could not download symbol: {
+                                     symbol_url} {resp.status_code}")
+
+            # Connection failures and timeouts leave the symbol not found
+            except (requests.RequestException, HTTPError) as exc:
+                pdbentry.found = False
+                logger.error(f"Could not download symbol: {
+                             symbol_url} {exc}")
+
+    # Any other failure, e.g. a full disk or a database error, also leaves
+    # the symbol not found, the caller logs it
+    except Exception:
+        db.rollback()
+        pdbentry.found = False
+        raise
+
+    # Always set the PDB entry to 'finished' downloading, an entry left
+    # downloading can never be claimed for download again
+    finally:
+        pdbentry.downloading = False
+        crud.modify_pdb_entry(db, pdbentry)
+
 
-    # Set the PDB entry to 'finished' downloading
-    pdbentry.downloading = False
-    crud.modify_pdb_entry(db, pdbentry)
+def download_symbol_in_flight(guid: str, pdbfile: str, loop: asyncio.AbstractEventLoop, event: asyncio.Event) -> None:
+    """ Download the symbol with its own session and wake up the requests waiting on it """
+
+    db = session_local()
+    try:
+        download_symbol(crud.find_pdb_entry(db, guid, pdbfile), db)
+    except Exception:
+        logger.exception(f"Failed to download symbol: {guid} {pdbfile}")
+    finally:
+        db.close()
+        loop.call_soon_threadsafe(finish_in_flight, (guid, pdbfile), event)
+
+
+def finish_in_flight(key: tuple[str, str], event: asyncio.Event) -> None:
+    """ Forget the finished download and wake up the requests waiting on it, runs
+    on the event loop so the request-side caches are only touched there """
+
+    _in_flight.pop(key, None)
+    _missing_files.pop(key, None)
+    event.set()
 
 
 def download_and_save_symbol(pdbentry, resp, db):
@@ -71,45 +281,67 @@ def download_and_save_symbol(pdbentry, resp, db):
     pdb_tmp_file_path = os.path.join(
         pdb_file_path, "tmp_"+pdbentry.pdbfile+".gzip")
 
-    # if the file is already compressed, just write the raw bytes
-    if is_gzip_supported:
-        pdbfile_handle = open(pdb_tmp_file_path, 'wb')
-    # else, we must compress it ourselves
-    else:
-        pdbfile_handle = gzip.open(pdb_tmp_file_path, 'wb')
-
     # Get the size of the PDB buffer being downloaded
+    # download_symbol commits the entry once the download is over
     pdb_size = get_pdb_size(resp)
     if pdb_size is None:
-        pdbentry.downloading = False
-        crud.modify_pdb_entry(db, pdbentry)
+        pdbentry.found = False
         return
 
-    # Dpwnload percentage calculation
+    # if the file is already compressed, just write the raw bytes
+    tmp_file_handle = open(pdb_tmp_file_path, 'wb',
+                           buffering=FILE_WRITE_BUFFER_SIZE)
+    advise_sequential(tmp_file_handle)
+    if is_gzip_supported:
+        pdbfile_handle = tmp_file_handle
+    # else, we must compress it ourselves, without a name or timestamp in
+    # the header so the same symbol always compresses to the same bytes
+    else:
+        pdbfile_handle = gzip.GzipFile(filename="", fileobj=tmp_file_handle, mode='wb',
+                                       compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)
+
+    # Stream the body as received, gzip encoded bodies are stored as is
     downloaded = 0
-    percent = 0
-    last_logged_percent = -1
-    while downloaded < pdb_size:
-        remaining = pdb_size - downloaded
-        chunk = resp.raw.read(min(CHUNK_SIZE, remaining))
-        pdbfile_handle.write(chunk)
-        downloaded += len(chunk)
-        percent = int((downloaded / pdb_size) * 100)
-        if percent // 5 > last_logged_percent:  # Log every 5%
-            last_logged_percent = percent // 5
-            logger.warning(f"Downloading... {pdbentry.guid} {
-                           pdbentry.pdbfile} {percent}%")
-
-    # Close the file handle
-    pdbfile_handle.close()
+    log_step = max(pdb_size // 20, 1)  # Log every 5%
+    next_log_threshold = log_step
+    try:
+        try:
+            for chunk in resp.raw.stream(get_download_chunk_size(pdb_size), decode_content=False):
+                pdbfile_handle.write(chunk)
+                downloaded += len(chunk)
+                if downloaded >= next_log_threshold:
+                    next_log_threshold = downloaded - downloaded % log_step + log_step
+                    logger.warning("Downloading... %s %s %d%%", pdbentry.guid,
+                                   pdbentry.pdbfile, downloaded * 100 // pdb_size)
+            if downloaded < pdb_size:
+                raise IncompleteRead(downloaded, pdb_size - downloaded)
+
+        # Close the file handles, GzipFile does not close the file it wraps
+        finally:
+            pdbfile_handle.close()
+            tmp_file_handle.close()
+
+    # Do not leave a partial download behind
+    except Exception:
+        os.remove(pdb_tmp_file_path)
+        raise
 
     # Finished downloading PDB
     logger.info(f"Successfully downloaded... {
                 pdbentry.guid} {pdbentry.pdbfile}")
 
-    # If the file is already a gzip, there is no need to compress it
+    # The temporary file is in the same directory, publish it with an atomic rename
     pdb_file_path = os.path.join(pdb_file_path, pdbentry.pdbfile+".gzip")
-    shutil.move(pdb_tmp_file_path, pdb_file_path)
+    os.replace(pdb_tmp_file_path, pdb_file_path)
+
+
+def get_download_chunk_size(pdb_size: int) -> int:
+    """ Pick the chunk size used to stream a download of pdb_size bytes """
+
+    for min_pdb_size, chunk_size in DOWNLOAD_CHUNK_SIZES:
+        if pdb_size >= min_pdb_size:
+            return chunk_size
+    return CHUNK_SIZE
 
 
 def get_pdb_size(resp):
@@ -125,51 +357,198 @@ def get_pdb_size(resp):
     return None
 
 
-def get_symbol(pdbname: str, pdbfile: str, guid: str, background_tasks: BackgroundTasks, db: Session, is_gzip_supported: bool):
+class ZeroCopyFileResponse(FileResponse):
+    """ FileResponse that hands the file to the ASGI server to sendfile(2) when it
+    supports the http.response.zerocopysend extension """
+
+    async def __call__(self, scope, receive, send):
+        if ("http.response.zerocopysend" not in (scope.get("extensions") or {})
+                or self.stat_result is None or self.send_header_only):
+            return await super().__call__(scope, receive, send)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        with open(self.path, 'rb') as file_handle:
+            await send({"type": "http.response.zerocopysend", "file": file_handle,
+                        "count": self.stat_result.st_size, "more_body": False})
+        if self.background is not None:
+            await self.background()
+
+
+def parse_range_header(range_header: str, file_size: int):
+    """ Parse a single 'bytes=' range into inclusive offsets, None if it must be ignored """
+
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_range:
+        return None
+
+    start, separator, end = byte_range.strip().partition("-")
+    if not separator:
+        return None
+
+    try:
+        # A suffix range requests the last N bytes of the file
+        if not start:
+            return max(file_size - int(end), 0), file_size - 1
+        start = int(start)
+        if not end:
+            return start, file_size - 1
+        end = int(end)
+    except ValueError:
+        return None
+
+    # A range ending before it starts is invalid and ignored, unlike a range
+    # starting past the end of the file which can not be satisfied
+    if end < start:
+        return None
+
+    return start, min(end, file_size - 1)
+
+
+def stream_file_range(file_path: str, start: int, length: int, chunk_size=CHUNK_SIZE):
+    """ Yield length bytes of the file beginning at offset start """
+
+    with open(file_path, 'rb') as file_handle:
+        advise_sequential(file_handle)
+        file_handle.seek(start)
+        while length > 0:
+            chunk = file_handle.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def stream_decompressed_file(file_path: str, chunk_size=GZIP_READ_SIZE):
+    """ Yield the decompressed contents of a gzip file, decompressing ahead on
+    _decompress_executor so decompression overlaps sending the previous chunks.
+    The chunks are awaited on the event loop, waiting on a producer that is
+    still queued for a worker must not hold one of Starlette's threadpool threads """
+
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxsize=DECOMPRESS_PREFETCH_CHUNKS)
+    stop = threading.Event()
+
+    def put(item):
+        # Blocks while the queue is full, the consumer makes room when it stops
+        asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+    def decompress():
+        try:
+            with open(file_path, 'rb') as file_handle, gzip.GzipFile(fileobj=file_handle, mode='rb') as gzip_file:
+                advise_sequential(file_handle)
+                while not stop.is_set():
+                    chunk = gzip_file.read(chunk_size)
+                    put(chunk)
+                    if not chunk:
+                        break
+        except Exception as exc:
+            put(exc)
+
+    producer = _decompress_executor.submit(decompress)
+    try:
+        while True:
+            chunk = await chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+            yield chunk
+
+    # A producer still waiting for a worker is dropped, a running one is
+    # woken up by emptying the queue and stops before its next read
+    finally:
+        stop.set()
+        producer.cancel()
+        while not chunks.empty():
+            chunks.get_nowait()
+
+
+def get_symbol(pdbname: str, pdbfile: str, guid: str, db: Session, is_gzip_supported: bool, is_x_accel_supported: bool = False, range_header: str = None):
     pdb_file_path = os.path.join(SYMBOL_PATH, pdbname, guid, pdbfile+".gzip")
 
-    if not os.path.isfile(pdb_file_path):
-        pdbentry = crud.find_pdb_entry(db, guid, pdbfile)
+    if (guid, pdbfile) in _missing_files:
+        return Response(status_code=404)
+
+    try:
+        pdb_stat = os.stat(pdb_file_path)
+    except FileNotFoundError:
+        _missing_files[(guid, pdbfile)] = True
+        with _not_found_lock:
+            if (guid, pdbfile) in _not_found:
+                return Response(status_code=404)
+        pdbentry = crud.claim_pdb_entry_download(db, guid, pdbname, pdbfile)
         if not pdbentry:
-            pdbentry = crud.create_pdb_entry(db, guid, pdbname, pdbfile)
-        if pdbentry.downloading:
             return Response(status_code=404)
-        pdbentry.downloading = True
-        crud.modify_pdb_entry(db, pdbentry)
-        background_tasks.add_task(download_symbol, pdbentry, db)
+        event = _in_flight[(guid, pdbfile)] = asyncio.Event()
+        _download_executor.submit(download_symbol_in_flight, guid, pdbfile,
+                                  asyncio.get_running_loop(), event)
         return Response(status_code=404)
 
-    pdbentry = crud.find_pdb_entry(db, guid, pdbfile)
-    if not pdbentry:
-        pdbentry = crud.create_pdb_entry(db, guid, pdbname, pdbfile, True)
+    # Make sure the cached symbol has an entry, entries are never deleted so
+    # this only needs to hit the database once per symbol
+    if (guid, pdbfile) not in _known_entries:
+        if not crud.find_pdb_entry(db, guid, pdbfile):
+            crud.create_pdb_entry(db, guid, pdbname, pdbfile, True)
+        _known_entries[(guid, pdbfile)] = True
+
+    if is_gzip_supported and is_x_accel_supported:
+        logger.debug("Returning gzip compressed stream via X-Accel-Redirect...")
+        return Response(headers={"X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PATH}/{pdbname}/{guid}/{pdbfile}.gzip",
+                                 "content-encoding": "gzip"}, media_type="application/octet-stream")
+
+    if is_gzip_supported and range_header:
+        byte_range = parse_range_header(range_header, pdb_stat.st_size)
+        if byte_range:
+            start, end = byte_range
+            if start > end:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{pdb_stat.st_size}"})
+            logger.debug("Returning gzip compressed range...")
+            headers = {
+                "Content-Range": f"bytes {start}-{end}/{pdb_stat.st_size}",
+                "Content-Length": str(end-start+1),
+                "Accept-Ranges": "bytes",
+                "content-encoding": "gzip"
+            }
+            return StreamingResponse(stream_file_range(pdb_file_path, start, end-start+1), status_code=206, headers=headers, media_type="application/octet-stream")
 
     if is_gzip_supported:
         logger.debug("Returning gzip compressed stream...")
-        return FileResponse(pdb_file_path, headers={"content-encoding": "gzip"}, media_type="application/octet-stream")
-
-    def stream_decompressed_data(chunk_size=CHUNK_SIZE):
-        with gzip.open(pdb_file_path, 'rb') as gzip_file:
-            while True:
-                chunk = gzip_file.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
+        return ZeroCopyFileResponse(pdb_file_path, headers={"content-encoding": "gzip", "Accept-Ranges": "bytes"}, media_type="application/octet-stream", stat_result=pdb_stat)
 
     logger.debug("Returning decompressed stream...")
-    return StreamingResponse(stream_decompressed_data(), media_type="application/octet-stream")
+    return StreamingResponse(stream_decompressed_file(pdb_file_path), media_type="application/octet-stream")
 
 
 @sym.get("/{pdbname}/{guid}/{pdbfile}")
 @sym.get("/download/symbols/{pdbname}/{guid}/{pdbfile}")
-async def get_symbol_api(pdbname: str, guid: str, pdbfile: str, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def get_symbol_api(pdbname: str, guid: str, pdbfile: str, request: Request, db: Session = Depends(get_db)):
+
+    # Reject names that could escape the symbol cache, the sanitized names
+    # are used for every path built while serving or downloading the symbol
+    try:
+        pdbname, guid, pdbfile = validate_pdb_entry_fields(pdbname, guid, pdbfile)
+    except ValueError:
+        return Response(status_code=400)
+
     accept_encoding = request.headers.get("Accept-Encoding", "")
     is_gzip_supported = "gzip" in accept_encoding.lower()
-    return get_symbol(pdbname, pdbfile, guid, background_tasks, db, is_gzip_supported)
+    is_x_accel_supported = "X-Accel-Support" in request.headers
+    range_header = request.headers.get("Range")
+
+    # Wait for a download of this symbol that is already in progress
+    event = _in_flight.get((guid, pdbfile))
+    if event:
+        try:
+            await asyncio.wait_for(event.wait(), IN_FLIGHT_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return Response(status_code=404)
+
+    return get_symbol(pdbname, pdbfile, guid, db, is_gzip_supported, is_x_accel_supported, range_header)
 
 
 @sym.get("/symbols")
-def get_symbol_entries(db: Session = Depends(get_db)) -> list:
-    return jsonable_encoder(db.query(models.SymbolEntry).all())
+def get_symbol_entries(skip: int = 0, limit: int | None = None, db: Session = Depends(get_db)):
+    return ORJSONResponse([dict(entry) for entry in crud.find_pdb_entries(db, skip, limit)])
 
 
 @sym.on_event("startup")
@@ -179,7 +558,9 @@ def fastsym_init():
     for download in downloads:
         failed_tmp_download = os.path.join(
             SYMBOL_PATH, download.pdbname, download.guid, "tmp_"+download.pdbfile+".gzip")
-        if os.path.exists(failed_tmp_download):
+        try:
             os.remove(failed_tmp_download)
-        download.downloading = False
-        crud.modify_pdb_entry(db, download)
+        except FileNotFoundError:
+            pass
+    crud.reset_still_downloading(db)
+    db.close()
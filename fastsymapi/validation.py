@@ -0,0 +1,37 @@
+from typing import NamedTuple
+import functools
+import re
+
+# Characters that are not valid in a Windows filename, plus control characters
+INVALID_PATH_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+# Most filesystems accept names of up to 255 characters, leave room for the
+# "tmp_" prefix and ".gzip" suffix added to the cached PDB file name
+MAX_PATH_COMPONENT_LENGTH = 255 - len("tmp_") - len(".gzip")
+
+
+class SanitizedNames(NamedTuple):
+    """ PDB entry fields that are safe to use as symbol cache path components """
+    pdbname: str
+    guid: str
+    pdbfile: str
+
+
+@functools.lru_cache(maxsize=8192)
+def sanitize_path_component(component: str) -> str:
+    """ Ensure a path component can not escape the symbol cache directory, the
+    same PDB names and GUIDs are requested over and over so valid ones are
+    memoized, invalid ones raise and are never cached """
+
+    if (not component or len(component) > MAX_PATH_COMPONENT_LENGTH
+            or ".." in component or INVALID_PATH_CHARS.search(component)):
+        raise ValueError(f"Invalid path component: {component!r}")
+    return component
+
+
+def validate_pdb_entry_fields(pdbname: str, guid: str, pdbfile: str) -> SanitizedNames:
+    """ Sanitize the PDB entry fields of a request once, at the request boundary """
+
+    return SanitizedNames(sanitize_path_component(pdbname),
+                          sanitize_path_component(guid),
+                          sanitize_path_component(pdbfile))
@@ -1,19 +1,42 @@
-from fastsymapi.symbols import download_symbol
+from fastsymapi.symbols import download_symbol, parse_range_header
+from fastsymapi import symbols
+from fastsymapi.validation import sanitize_path_component
 from fastsymapi.sql_db import models
+from fastsymapi.sql_db import crud, database
+from fastsymapi.sql_db.database import get_db
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import Session, sessionmaker
 from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
 from fastsymapi import app
+import requests
 import pytest
+import gzip
+import errno
+import os
+import asyncio
+import threading
 
-client = TestClient(app)
 
+@pytest.fixture(autouse=True, scope="session")
+def offline_symbol_servers():
+    """Keep every test, and the downloads it starts, off the real symbol servers"""
 
-@pytest.fixture
-def mock_gzip_open():
-    return MagicMock()
+    with patch("fastsymapi.symbols._session", MagicMock(spec=requests.Session)) as session:
+        yield session
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Test client running the app's startup and shutdown once for the whole run"""
+
+    with TestClient(app) as test_client:
+        yield test_client
 
 
-def test_fail_get_symbol_api():
+def test_fail_get_symbol_api(client):
     """Test a failed symbol retrieval"""
 
     response = client.get("/download/symbols/notreal/notreal/pdbfile")
@@ -21,34 +44,394 @@ def test_fail_get_symbol_api():
     assert response.status_code == 404  # or whatever status code you expect
 
 
-@patch("gzip.open")
-@patch("fastsymapi.symbols.requests.get")
-@patch("fastsymapi.symbols.crud.modify_pdb_entry")
-@patch("fastsymapi.symbols.crud.create_pdb_entry")
-@patch("fastsymapi.symbols.os.path.exists")
-@patch("fastsymapi.symbols.os.makedirs")
-@patch("fastsymapi.symbols.open", new_callable=MagicMock)
-@patch("fastsymapi.symbols.shutil.move")
-def test_successful_pdb_download(
-    self,
-    mock_move,
-    mock_open,
-    mock_makedirs,
-    mock_exists,
-    mock_create_pdb_entry,
-    mock_modify_pdb_entry,
-    mock_get,
-    mock_gzip_open,
-):
+def test_get_symbol_entries_pagination(client, db, monkeypatch):
+    """Test listing the symbol entries a page at a time"""
+
+    crud.create_pdb_entry(db, "guid1", "first", "first.pdb", True)
+    crud.create_pdb_entry(db, "guid2", "second", "second.pdb", True)
+    monkeypatch.setitem(app.dependency_overrides, get_db, lambda: db)
+
+    first_page = client.get("/symbols", params={"skip": 0, "limit": 1})
+    second_page = client.get("/symbols", params={"skip": 1, "limit": 1})
+
+    assert first_page.status_code == 200
+    assert second_page.status_code == 200
+    assert [entry["pdbname"] for entry in first_page.json()] == ["first"]
+    assert [entry["pdbname"] for entry in second_page.json()] == ["second"]
+
+
+@pytest.mark.parametrize("range_header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-9,20-29", None),
+    ("items=0-99", None),
+    ("bytes=abc", None),
+    ("bytes=5-3", None),
+    ("bytes=1000-", (1000, 999)),
+])
+def test_parse_range_header(range_header, expected):
+    """Test parsing of the Range header used to resume downloads"""
+
+    assert parse_range_header(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize("component", [
+    "ntdll.pdb", "1D2B4C3F6A5E4D3C2B1A0F9E8D7C6B5A1", "chrome.dll.pdb", "file_1-2", "valid_file"
+])
+def test_sanitize_valid_path_component(component):
+    """Test that symbol names are accepted as path components"""
+
+    assert sanitize_path_component(component) == component
+
+
+@pytest.mark.parametrize("component", [
+    None, "", "..", "../evil", "..\\evil", "normal/../traversal",
+    "a/b", "a\\b", "a<b", "a|b", "a*b", "a\x00b", "a"*256
+])
+def test_sanitize_invalid_path_component(component):
+    """Test that path traversal attempts are rejected"""
+
+    with pytest.raises(ValueError):
+        sanitize_path_component(component)
+
+
+@pytest.fixture
+def mock_session(monkeypatch, tmp_path):
+    """Symbol server session of fastsymapi.symbols, downloading into tmp_path"""
+
+    session = MagicMock()
+    monkeypatch.setattr(symbols, "_session", session)
+    monkeypatch.setattr(symbols, "_not_found", {})
+    monkeypatch.setattr(symbols, "SYMBOL_PATH", str(tmp_path))
+    monkeypatch.setattr(symbols.crud, "modify_pdb_entry", MagicMock())
+    return session
+
+
+@pytest.fixture
+def pdbentry():
+    """Symbol entry to download"""
+
+    return models.SymbolEntry(pdbname="test", guid="test", pdbfile="test")
+
+
+def test_successful_pdb_download(mock_session, pdbentry, tmp_path):
+    # Arrange
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.headers = {"Content-Length": "4"}
+    mock_response.raw.stream.return_value = [b"data"]
+    mock_session.head.return_value.status_code = 200
+    mock_session.get.return_value.__enter__.return_value = mock_response
+    db = MagicMock(spec=Session)
+
+    # Act
+    download_symbol(pdbentry, db)
+
+    # Assert
+    with gzip.open(tmp_path / "test" / "test" / "test.gzip", "rb") as pdbfile:
+        assert pdbfile.read() == b"data"
+    assert pdbentry.found
+    assert not pdbentry.downloading
+
+
+def test_download_symbol_all_servers_fail(mock_session, pdbentry):
+    # Arrange
+    mock_session.head.return_value.status_code = 404
+    db = MagicMock(spec=Session)
+
+    # Act
+    download_symbol(pdbentry, db)
+
+    # Assert
+    mock_session.get.assert_not_called()
+    assert not pdbentry.found
+    assert not pdbentry.downloading
+    assert ("test", "test") in symbols._not_found
+
+
+def test_create_requests_session():
+    # Act
+    session = symbols.create_requests_session()
+
+    # Assert
+    adapter = session.get_adapter("https://msdl.microsoft.com")
+    assert adapter is session.get_adapter("http://msdl.microsoft.com")
+    retry = adapter.max_retries
+    assert retry.total == 3
+    assert retry.connect == 2
+    assert retry.read == 2
+    assert retry.backoff_factor == 0.2
+    assert set(retry.status_forcelist) == {429, 500, 502, 503, 504}
+    assert retry.allowed_methods == {"HEAD", "GET"}
+    assert not retry.raise_on_status
+    assert retry.respect_retry_after_header
+
+
+def test_download_symbol_failure_releases_entry(mock_session, pdbentry, tmp_path):
     # Arrange
     mock_response = MagicMock()
     mock_response.status_code = 200
-    mock_get.return_value = mock_response
-    mock_exists.return_value = False
-    mock_open.return_value.__enter__.return_value = MagicMock()
-    mock_gzip_open.return_value.__enter__.return_value = MagicMock()
-    pdbentry = models.SymbolEntry(pdbname="test", guid="test", pdbfile="test")
-    db = MagicMock()
+    mock_response.headers = {"Content-Length": "4"}
+    mock_response.raw.stream.side_effect = OSError(errno.ENOSPC, "No space left on device")
+    mock_session.head.return_value.status_code = 200
+    mock_session.get.return_value.__enter__.return_value = mock_response
+    pdbentry.downloading = True
+    db = MagicMock(spec=Session)
+
+    # Act
+    with pytest.raises(OSError):
+        download_symbol(pdbentry, db)
+
+    # Assert
+    assert not pdbentry.found
+    assert not pdbentry.downloading
+    symbols.crud.modify_pdb_entry.assert_called_once_with(db, pdbentry)
+    assert not (tmp_path / "test" / "test" / "tmp_test.gzip").exists()
+
+
+@pytest.mark.parametrize("head", [
+    {"side_effect": requests.ConnectionError("Name or service not known")},
+    {"return_value": MagicMock(status_code=503)},
+])
+def test_download_symbol_servers_unavailable(mock_session, pdbentry, head):
+    # Arrange
+    mock_session.head.configure_mock(**head)
+    db = MagicMock(spec=Session)
 
     # Act
     download_symbol(pdbentry, db)
+
+    # Assert
+    mock_session.get.assert_not_called()
+    assert not pdbentry.found
+    assert not pdbentry.downloading
+    assert ("test", "test") not in symbols._not_found
+
+
+async def read_decompressed_file(file_path, chunk_size, max_chunks=None):
+    """Collect the chunks of a decompressed stream, stopping early after max_chunks"""
+
+    chunks = []
+    stream = symbols.stream_decompressed_file(str(file_path), chunk_size=chunk_size)
+    async for chunk in stream:
+        chunks.append(chunk)
+        if len(chunks) == max_chunks:
+            break
+    await stream.aclose()
+    return chunks
+
+
+@pytest.fixture
+def gzip_pdb_file(tmp_path):
+    """Cached symbol that decompresses into more chunks than are read ahead"""
+
+    pdb_file_path = tmp_path / "test.gzip"
+    with gzip.open(pdb_file_path, "wb") as pdbfile:
+        pdbfile.write(b"0123456789" * 10)
+    return pdb_file_path
+
+
+def test_stream_decompressed_file(tmp_path):
+    # Arrange
+    pdb_file_path = tmp_path / "test.gzip"
+    with gzip.open(pdb_file_path, "wb") as pdbfile:
+        pdbfile.write(b"0123456789")
+
+    # Act
+    chunks = asyncio.run(read_decompressed_file(pdb_file_path, 4))
+
+    # Assert
+    assert chunks == [b"0123", b"4567", b"89"]
+
+
+def test_stream_decompressed_file_concurrent_streams(gzip_pdb_file):
+    # Arrange
+    stream_count = symbols.MAX_CONCURRENT_DECOMPRESSIONS * 2
+
+    async def read_all():
+        return await asyncio.wait_for(asyncio.gather(
+            *(read_decompressed_file(gzip_pdb_file, 4) for _ in range(stream_count))), 10)
+
+    # Act, streams beyond the executor's workers wait without blocking the others
+    results = asyncio.run(read_all())
+
+    # Assert
+    assert all(b"".join(chunks) == b"0123456789" * 10 for chunks in results)
+
+
+def test_stream_decompressed_file_stop_frees_worker(monkeypatch, gzip_pdb_file):
+    # Arrange
+    monkeypatch.setattr(symbols, "_decompress_executor", ThreadPoolExecutor(max_workers=1))
+
+    async def read_after_stop():
+        stream = symbols.stream_decompressed_file(str(gzip_pdb_file), chunk_size=4)
+        await anext(stream)
+        await asyncio.sleep(0.2)  # Let the producer fill the queue and block
+        await stream.aclose()
+        return await asyncio.wait_for(read_decompressed_file(gzip_pdb_file, 4), 10)
+
+    # Act, the producer of the stopped stream blocks on a full queue until woken
+    chunks = asyncio.run(read_after_stop())
+
+    # Assert
+    assert b"".join(chunks) == b"0123456789" * 10
+
+
+@pytest.fixture
+def db():
+    """Session on an empty in-memory SQLite database, shared with the threads
+    the routes run on"""
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                           poolclass=StaticPool)
+    database.base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as session:
+        yield session
+    engine.dispose()
+
+
+def test_claim_pdb_entry_download(db):
+    # Act
+    first_claim = crud.claim_pdb_entry_download(db, "test", "test", "test")
+    second_claim = crud.claim_pdb_entry_download(db, "test", "test", "test")
+
+    # Assert
+    assert first_claim.downloading
+    assert not first_claim.found
+    assert second_claim is None
+
+    # Act
+    first_claim.downloading = False
+    crud.modify_pdb_entry(db, first_claim)
+    third_claim = crud.claim_pdb_entry_download(db, "test", "test", "test")
+
+    # Assert
+    assert third_claim.id == first_claim.id
+    assert third_claim.downloading
+
+
+def test_get_symbol_api_waits_for_in_flight_download(client, monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.setattr(symbols, "SYMBOL_PATH", str(tmp_path))
+    key = ("inflightguid", "inflight.pdb")
+    event = asyncio.Event()
+    monkeypatch.setitem(symbols._in_flight, key, event)
+
+    def finish_download():
+        (tmp_path / "inflight" / "inflightguid").mkdir(parents=True)
+        with gzip.open(tmp_path / "inflight" / "inflightguid" / "inflight.pdb.gzip", "wb") as pdbfile:
+            pdbfile.write(b"data")
+        client.portal.call(symbols.finish_in_flight, key, event)
+
+    # Act, the symbol only exists once the download it waits on finishes
+    timer = threading.Timer(0.1, finish_download)
+    timer.start()
+    response = client.get("/inflight/inflightguid/inflight.pdb")
+    timer.join()
+
+    # Assert
+    assert response.status_code == 200
+    assert response.content == b"data"
+    assert key not in symbols._in_flight
+
+
+def test_get_symbol_api_in_flight_download_timeout(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(symbols, "IN_FLIGHT_WAIT_TIMEOUT", 0.1)
+    monkeypatch.setitem(symbols._in_flight, ("slowguid", "slow.pdb"), asyncio.Event())
+
+    # Act
+    response = client.get("/slow/slowguid/slow.pdb")
+
+    # Assert
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def cached_symbol(monkeypatch, tmp_path):
+    """Symbol already downloaded into a temporary SYMBOL_PATH, returns its gzip bytes"""
+
+    monkeypatch.setattr(symbols, "SYMBOL_PATH", str(tmp_path))
+    (tmp_path / "cached" / "cachedguid").mkdir(parents=True)
+    pdb_file_path = tmp_path / "cached" / "cachedguid" / "cached.pdb.gzip"
+    with gzip.open(pdb_file_path, "wb") as pdbfile:
+        pdbfile.write(b"0123456789")
+    return pdb_file_path.read_bytes()
+
+
+@pytest.mark.parametrize("range_header, status_code, content_range, start, end", [
+    ("bytes=0-9", 206, "bytes 0-9/{size}", 0, 10),
+    ("bytes=-5", 206, "bytes {last5}-{last}/{size}", -5, None),
+    ("bytes=5-3", 200, None, 0, None),
+    ("bytes=999-", 416, "bytes */{size}", 0, 0),
+])
+def test_get_symbol_api_range(client, cached_symbol, range_header, status_code, content_range, start, end):
+    # Act
+    with client.stream("GET", "/cached/cachedguid/cached.pdb",
+                       headers={"Accept-Encoding": "gzip", "Range": range_header}) as response:
+        content = b"".join(response.iter_raw())
+
+    # Assert, the gzip bytes are sent as stored
+    size = len(cached_symbol)
+    assert response.status_code == status_code
+    assert response.headers.get("Content-Range") == (content_range and content_range.format(
+        size=size, last5=size - 5, last=size - 1))
+    assert content == cached_symbol[start:end]
+
+
+@pytest.mark.parametrize("extensions, zerocopy", [
+    ({"http.response.zerocopysend": {}}, True),
+    ({}, False),
+    (None, False),
+])
+def test_zero_copy_file_response(tmp_path, extensions, zerocopy):
+    # Arrange
+    pdb_file_path = tmp_path / "test.gzip"
+    pdb_file_path.write_bytes(b"data")
+    response = symbols.ZeroCopyFileResponse(str(pdb_file_path), stat_result=os.stat(pdb_file_path))
+    scope = {"type": "http", "method": "GET", "headers": [], "extensions": extensions}
+    messages = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            message = dict(message, file=message["file"].read())
+        messages.append(message)
+
+    # Act
+    asyncio.run(response(scope, None, send))
+
+    # Assert
+    assert messages[0]["type"] == "http.response.start"
+    assert messages[0]["status"] == 200
+    if zerocopy:
+        assert messages[1:] == [{"type": "http.response.zerocopysend", "file": b"data",
+                                 "count": 4, "more_body": False}]
+    else:
+        assert [message["type"] for message in messages[1:]] == ["http.response.body"]
+        assert messages[1]["body"] == b"data"
+
+
+def test_get_symbol_api_x_accel_redirect(client, cached_symbol):
+    # Act
+    response = client.get("/cached/cachedguid/cached.pdb",
+                          headers={"Accept-Encoding": "gzip", "X-Accel-Support": "1"})
+
+    # Assert, nginx sends the file from the internal location
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == "/internal/symbols/cached/cachedguid/cached.pdb.gzip"
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content == b""
+
+
+def test_get_symbol_api_x_accel_without_gzip(client, cached_symbol):
+    # Act
+    response = client.get("/cached/cachedguid/cached.pdb",
+                          headers={"Accept-Encoding": "identity", "X-Accel-Support": "1"})
+
+    # Assert, clients that do not accept gzip still get the decompressed symbol
+    assert response.status_code == 200
+    assert "X-Accel-Redirect" not in response.headers
+    assert "content-encoding" not in response.headers
+    assert response.content == b"0123456789"